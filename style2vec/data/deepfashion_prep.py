@@ -1,8 +1,6 @@
 import tensorflow as tf
 import numpy as np
 import re
-from PIL import Image as PILImage
-from tensorflow.python.keras.preprocessing import image
 
 
 class Item:
@@ -135,13 +133,14 @@ def prep_image(item: Item, data_dir: str) -> np.ndarray:
     Prepare image for InceptionV3 model
     :param item: Parsed item to prepare
     :param data_dir: Dataset root directory
-    :return: Array with preprocessed product image
+    :return: uint8 array with resized product image
     """
-    img = image.load_img(data_dir + item.path)  # type: PILImage.Image
-    img = img.crop(item.bbox)
-    img = img.resize((299, 299))
-    img_array = image.img_to_array(img)
-    return tf.keras.applications.inception_v3.preprocess_input(img_array)
+    x1, y1, x2, y2 = item.bbox
+    # Decode only the bounding box area
+    img = tf.io.decode_and_crop_jpeg(tf.io.read_file(data_dir + item.path), [y1, x1, y2 - y1, x2 - x1],
+                                     channels=3, dct_method='INTEGER_FAST')
+    img = tf.image.resize(img, [299, 299])
+    return tf.cast(tf.round(img), tf.uint8).numpy()
 
 
 def get_embedding(model, items: dict, data_dir: str):
@@ -1,34 +1,38 @@
 import json
-import random
 import numpy as np
 import tensorflow as tf
 import math
-from pathlib import Path
 
 
 class SamplesGenerator:
 
-    def __init__(self, dataset_path: str, images_path: str, neg_sample_count: int = 5, batch_size: int = 10,
-                 underlying_model: str = 'inception', outfits_count_limit: int = -1, samples_count_limit: int = -1):
+    def __init__(self, dataset_path: str, images_path: str, batch_size: int = 10,
+                 underlying_model: str = 'inception', outfits_count_limit: int = -1, samples_count_limit: int = -1,
+                 cache_path: str = 'image_cache.npy'):
         """
         :param dataset_path: Path to your dataset path
         :param images_path: Path to the folder with images
-        :param neg_sample_count: Number of negative samples per item
         :param batch_size: Number of samples in one batch
         :param underlying_model: Model to use: ('inception')
         :param outfits_count_limit: Maximum number of outfits used for generating samples (-1 for inf)
         :param samples_count_limit: Maximum number of samples (-1 for inf)
+        :param cache_path: Path to the memory-mapped file with decoded images
         """
         self.outfits_count_limit = outfits_count_limit
         self.samples_count_limit = samples_count_limit
         self.batch_size = batch_size
-        self.neg_sample_count = neg_sample_count
         self.images_path = images_path
         self.dataset_path = dataset_path
         self.underlying_model = underlying_model
+        self.cache_path = cache_path
         self.data = None
+        self.items = None
+        self.item_outfits = None
+        self.image_paths = None
+        self.item_images = None
         self.steps_per_epoch = None
         self.samples = None
+        self.image_cache = None
 
         if underlying_model != 'inception':
             raise ValueError("Invalid underlying model")
@@ -41,81 +45,112 @@ class SamplesGenerator:
             self.data = json.load(json_file)
             if self.outfits_count_limit != -1 and self.outfits_count_limit < len(self.data):
                 self.data = self.data[:self.outfits_count_limit]
+
+        # Flatten outfits into a single list of items with their outfit indexes
+        self.items = [item for outfit in self.data for item in outfit["Items"]]
+        outfit_sizes = [len(outfit["Items"]) for outfit in self.data]
+        self.item_outfits = np.repeat(np.arange(len(self.data)), outfit_sizes)
+
+        # Items sharing an image are decoded only once
+        self.image_paths, self.item_images = np.unique([item["ImagePath"] for item in self.items],
+                                                       return_inverse=True)
         print("Dataset has been successfully loaded (" + str(len(self.data)) + " outfits).")
 
     def generate_samples(self):
         """
-        Generates samples with labels
-        :return: List of couples and labels (0/1)
+        Generates positive samples, negatives are the other samples in the same batch
+        :return: Rows of target item indexes, context item indexes and outfit indexes
         """
         if self.data is None:
             self.collect_data()
 
-        samples = []
-        for outfit in self.data:
-            for item in outfit["Items"]:
-                # Add positive samples
-                for context in outfit["Items"]:
-                    if item != context:
-                        samples.append(((item, context), 1))
-                # Add negative samples
-                for i in range(self.neg_sample_count):
-                    while True:
-                        neg_outfit_index = random.randrange(len(self.data) - 1)
-                        if neg_outfit_index != outfit["SetId"]:
-                            break
-                    neg_item = random.choice(self.data[neg_outfit_index]["Items"])
-                    samples.append(((item, neg_item), 0))
-        random.shuffle(samples)
-        if self.samples_count_limit != -1 and self.samples_count_limit < len(samples):
-            samples = samples[:self.samples_count_limit]
-
-        self.steps_per_epoch = math.floor(len(samples) / self.batch_size)
-
-        couples, labels = zip(*samples)
-        self.samples = couples, labels
-        print(str(len(samples)) + " samples generated.")
-
-    def generate_batches(self):
+        outfit_sizes = np.bincount(self.item_outfits, minlength=len(self.data))
+        outfit_starts = np.cumsum(outfit_sizes) - outfit_sizes
+
+        # Every ordered couple of distinct items within an outfit, index pairs are computed once per outfit size
+        targets, contexts = [], []
+        for size in np.unique(outfit_sizes):
+            starts = outfit_starts[outfit_sizes == size]
+            pair_targets, pair_contexts = np.where(~np.eye(size, dtype=bool))
+            targets.append((starts[:, None] + pair_targets).ravel())
+            contexts.append((starts[:, None] + pair_contexts).ravel())
+        targets = np.concatenate(targets)
+        contexts = np.concatenate(contexts)
+
+        permutation = np.random.permutation(len(targets))
+        if self.samples_count_limit != -1 and self.samples_count_limit < len(permutation):
+            permutation = permutation[:self.samples_count_limit]
+
+        self.steps_per_epoch = math.floor(len(permutation) / self.batch_size)
+
+        # Shuffled samples are written in place into one compact array
+        self.samples = np.empty((3, len(permutation)), dtype=np.int32)
+        np.take(targets, permutation, out=self.samples[0])
+        np.take(contexts, permutation, out=self.samples[1])
+        np.take(self.item_outfits, self.samples[0], out=self.samples[2])
+        print(str(len(permutation)) + " samples generated.")
+
+    def build_image_cache(self, batch_size: int = 64):
         """
-        Batch generator method
+        Decodes every distinct image once into memory-mapped uint8 array indexed by image index
+        :param batch_size: Number of images written to the cache at once
         """
+        if self.data is None:
+            self.collect_data()
 
-        if self.samples is None:
-            self.generate_samples()
+        self.image_cache = np.lib.format.open_memmap(self.cache_path, mode='w+', dtype=np.uint8,
+                                                     shape=(len(self.image_paths), 299, 299, 3))
+        images = tf.data.Dataset.from_tensor_slices([self.images_path + path for path in self.image_paths])
+        images = images.map(load_image, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        images = images.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        for start, batch in zip(range(0, len(self.image_paths), batch_size), images):
+            self.image_cache[start:start + len(batch)] = batch.numpy()
+        self.image_cache.flush()
+        print("Image cache has been successfully built (" + str(len(self.image_paths)) + " images).")
 
-        couples, labels = self.samples
-        labels = labels
-        item_target, item_context = zip(*couples)
-        target_items = np.array(item_target)
-        context_items = np.array(item_context)
-
-        while True:
-            current_size = 0
-            batched_targets, batched_contexts, batched_labels = [], [], []
-            for i, target in enumerate(target_items):
-                if current_size < self.batch_size:
-                    batched_targets.append(self.prep_item(target))
-                    batched_contexts.append(self.prep_item(context_items[i]))
-                    batched_labels.append(labels[i])
-                    current_size += 1
-                else:
-                    yield ([np.array(batched_targets), np.array(batched_contexts)], np.array(batched_labels))
-                    current_size = 0
-                    batched_targets, batched_contexts, batched_labels = [], [], []
-            if current_size > 0:
-                yield ([np.array(batched_targets), np.array(batched_contexts)], np.array(batched_labels))
-
-    def prep_item(self, item):
+    def as_dataset(self, features=None, shuffle_buffer_size: int = 10000):
         """
-        Transforms dataset item into the model input
-        :param item: Dataset item
-        :return: Model input
+        Creates endless shuffled input pipeline for the model
+        :param features: Precomputed image features used instead of cached images (None for images)
+        :param shuffle_buffer_size: Number of samples in the shuffle buffer
+        :return: Dataset of batched (target, context) couples with their outfit indexes
         """
-        if self.underlying_model == 'inception':
-            img = tf.keras.preprocessing.image.load_img(Path(self.images_path + item["ImagePath"]),
-                                                        target_size=(299, 299))
-            x = tf.keras.preprocessing.image.img_to_array(img)
-            return tf.keras.applications.inception_v3.preprocess_input(x)
-        else:
-            raise ValueError("Preprocessing not defined for this model")
+        if self.samples is None:
+            self.generate_samples()
+        if features is None and self.image_cache is None:
+            self.build_image_cache()
+        source = self.image_cache if features is None else features
+
+        targets, contexts, outfits = self.samples
+        dataset = tf.data.Dataset.from_tensor_slices(((self.item_images[targets], self.item_images[contexts]),
+                                                      outfits))
+        dataset = dataset.shuffle(shuffle_buffer_size).repeat().batch(self.batch_size)
+        dataset = dataset.map(lambda couple, outfit: ((gather(source, couple[0]), gather(source, couple[1])), outfit),
+                              num_parallel_calls=tf.data.AUTOTUNE)
+        # Samples are shuffled anyway, so parallel batches may be delivered in completion order
+        options = tf.data.Options()
+        options.deterministic = False
+        return dataset.prefetch(tf.data.AUTOTUNE).with_options(options)
+
+
+def gather(source: np.ndarray, indexes):
+    """
+    Gathers rows of given images
+    :param source: Array indexed by image index
+    :param indexes: Tensor with image indexes
+    :return: Tensor with gathered rows
+    """
+    rows = tf.numpy_function(lambda i: source[i], [indexes], tf.as_dtype(source.dtype))
+    rows.set_shape((None,) + source.shape[1:])
+    return rows
+
+
+def load_image(path):
+    """
+    Loads image and resizes it to the model input size
+    :param path: Path to the image
+    :return: uint8 image tensor
+    """
+    img = tf.io.decode_jpeg(tf.io.read_file(path), channels=3, dct_method='INTEGER_FAST')
+    img = tf.image.resize(img, [299, 299])
+    return tf.cast(tf.round(img), tf.uint8)
@@ -21,8 +21,8 @@ def main():
     print(str(len(items)) + " items parsed")
 
     model = Style2Vec("train_no_dup_out.json", "../data/images/", batch_size=1, outfits_count_limit=3)
-    target = model.model_target  # type: tf.keras.models.Model
-    target.load_weights(args.model_path, True)
+    model.model.load_weights(args.model_path)
+    target = model.backbone  # type: tf.keras.models.Model
 
     emb, paths = preprocessing.get_embedding(target, items, args.img_base_dir)
 
@@ -1,7 +1,7 @@
 import json
 import numpy as np
 import tensorflow as tf
-from pathlib import Path
+from style2vec.data.sample_generator import load_image
 from style2vec.models.style2vec import Style2Vec
 
 
@@ -57,15 +57,12 @@ class Embedding:
         :param item: Dataset item
         :return: Model input
         """
-        img = tf.keras.preprocessing.image.load_img(
-            Path("../dataset/images/" + path_to_img), target_size=(299, 299))
-        x = tf.keras.preprocessing.image.img_to_array(img)
-        return tf.keras.applications.inception_v3.preprocess_input(x)
+        return load_image("../dataset/images/" + path_to_img).numpy()
 
 
 model = Style2Vec("train_no_dup_out.json", "../data/images/", batch_size=1, outfits_count_limit=3)
-target = model.model_target  # type: tf.keras.models.Model
-target.load_weights('logs/20190910-193051/model20190910-193051.h5', True)
+model.model.load_weights('logs/20190910-193051/model20190910-193051.h5')
+target = model.backbone  # type: tf.keras.models.Model
 embedding = Embedding(target)
 data = embedding.collect_data("../data/label/valid_no_dup_out.json")
 emb, paths = embedding.get_embedding(data)
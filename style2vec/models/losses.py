@@ -0,0 +1,77 @@
+import tensorflow as tf
+
+
+def similarity_matrix(embeddings):
+    """
+    Cosine similarities between every target and every context in the batch
+    :param embeddings: Couple of target and context embedding tensors
+    :return: Tensor (targets x contexts) with similarities, matching couples on the diagonal
+    """
+    targets, contexts = embeddings
+    targets = tf.math.l2_normalize(targets, axis=1)
+    contexts = tf.math.l2_normalize(contexts, axis=1)
+    return tf.matmul(targets, contexts, transpose_b=True)
+
+
+def mask_outfit_contexts(outfits, similarity, value):
+    """
+    Replaces similarities of off-diagonal couples from the same outfit, which are not valid negatives
+    :param outfits: Tensor with outfit index of every couple in the batch
+    :param similarity: Similarity matrix of the batch
+    :param value: Value used for masked similarities
+    :return: Masked similarity matrix
+    """
+    outfits = tf.reshape(outfits, [-1])
+    same_outfit = tf.equal(outfits[:, None], outfits[None, :])
+    diagonal = tf.eye(tf.shape(similarity)[0], dtype=tf.bool)
+    return tf.where(same_outfit & ~diagonal, tf.fill(tf.shape(similarity), value), similarity)
+
+
+def in_batch_softmax_loss(temperature: float = 0.1):
+    """
+    NT-Xent loss using other contexts in the batch as negatives
+    :param temperature: Temperature of the softmax
+    :return: Keras loss function of outfit indexes and similarity matrix
+    """
+    def loss(outfits, similarity):
+        logits = mask_outfit_contexts(outfits, similarity, -1e9) / temperature
+        labels = tf.range(tf.shape(similarity)[0])
+        return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits)
+
+    return loss
+
+
+def in_batch_accuracy(outfits, similarity):
+    """
+    Fraction of targets whose most similar in-batch context is their own one
+    :param outfits: Tensor with outfit index of every couple in the batch
+    :param similarity: Similarity matrix of the batch
+    :return: Tensor with 1 for correctly matched targets and 0 otherwise
+    """
+    predictions = tf.argmax(mask_outfit_contexts(outfits, similarity, -1e9), axis=1, output_type=tf.int32)
+    return tf.cast(tf.equal(predictions, tf.range(tf.shape(similarity)[0])), tf.float32)
+
+
+def semi_hard_triplet_loss(margin: float = 0.2):
+    """
+    Triplet loss with online semi-hard negative mining over the batch: for every target the most similar
+    negative context that is still less similar than its own context is used (or the least similar negative
+    context if there is no such one)
+    :param margin: Required gap between positive and negative similarity
+    :return: Keras loss function of outfit indexes and similarity matrix
+    """
+    def loss(outfits, similarity):
+        outfits = tf.reshape(outfits, [-1])
+        negatives = tf.not_equal(outfits[:, None], outfits[None, :])
+        positive = tf.linalg.diag_part(similarity)
+
+        # Cosine similarities lie in [-1, 1], so -2 and 2 never win the reductions
+        semi_hard = negatives & (similarity < positive[:, None])
+        semi_hard_negative = tf.reduce_max(tf.where(semi_hard, similarity, -2.), axis=1)
+        easy_negative = tf.reduce_min(tf.where(negatives, similarity, 2.), axis=1)
+        negative = tf.where(tf.reduce_any(semi_hard, axis=1), semi_hard_negative, easy_negative)
+
+        triplet_loss = tf.maximum(negative - positive + margin, 0.)
+        return tf.where(tf.reduce_any(negatives, axis=1), triplet_loss, 0.)
+
+    return loss
@@ -8,11 +8,34 @@ import os
 from pathlib import Path
 from tensorboard.plugins.hparams import api as hp
 from style2vec.data.sample_generator import SamplesGenerator
+from style2vec.models import losses
 import time
 
 date = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# Compute in float16 while keeping variables in float32
+tf.keras.mixed_precision.set_global_policy('mixed_float16')
+
+
+class Dequantize(tf.keras.layers.Layer):
+    """Scales uint8 quantized features back to float with non-trainable per-channel scale"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('dtype', 'float32')
+        super().__init__(**kwargs)
+        self.scale = None
+
+    def build(self, input_shape):
+        self.scale = self.add_weight(name='scale', shape=(input_shape[-1],), initializer='ones', trainable=False)
+        super().build(input_shape)
+
+    def call(self, inputs):
+        return tf.cast(inputs, self.dtype) * self.scale
+
+    def get_config(self):
+        return super().get_config()
+
 
 class Style2Vec:
 
@@ -30,7 +53,7 @@ class Style2Vec:
         :type hparams: Hyperparameters
         :param dataset_path: Path to your dataset path
         :param images_path: Path to the folder with images
-        :param batch_size: Number of samples in one batch
+        :param batch_size: Number of samples in one batch per GPU
         :param epochs_count: Number of epochs
         :param underlying_model: Model to use: ('inception')
         :param outfits_count_limit: Maximum number of outfits used for generating samples (-1 for inf)
@@ -39,85 +62,156 @@ class Style2Vec:
         self.hparams = hparams
         self.epochs_count = epochs_count
         self.history = None
-        # Create input layers
-        input_target = tf.keras.layers.Input((299, 299, 3))
-        input_context = tf.keras.layers.Input((299, 299, 3))
-
-        # Initialize underlying models
-        self.model_target = tf.keras.applications.inception_v3.InceptionV3(  # type: tf.keras.models.Model
-            weights='imagenet',
-            include_top=False,
-            pooling='avg',
-            input_tensor=input_target
-        )
+        # Replicate model on all available GPUs
+        self.strategy = tf.distribute.MirroredStrategy()
+        with self.strategy.scope():
+            # Create input layers
+            input_target = tf.keras.layers.Input((299, 299, 3), dtype='uint8')
+            input_context = tf.keras.layers.Input((299, 299, 3), dtype='uint8')
 
-        self.model_context = tf.keras.applications.inception_v3.InceptionV3(
-            weights='imagenet',
-            include_top=False,
-            pooling='avg',
-            input_tensor=input_context
-        )
+            # Preprocess uint8 images on the device
+            input_image = tf.keras.layers.Input((299, 299, 3), dtype='uint8')
+            prep_image = tf.keras.layers.Rescaling(1. / 127.5, offset=-1.)(input_image)
+
+            # Initialize underlying model shared by target and context items
+            self.backbone = tf.keras.applications.inception_v3.InceptionV3(  # type: tf.keras.models.Model
+                weights='imagenet',
+                include_top=False,
+                pooling='avg',
+                input_tensor=prep_image
+            )
+            self.model_frozen = None
+            self.dequantize = None
+
+            if hparams[HP_FINE_TUNE]:
+                # Set up fine-tuning (only inception blocks after mixed8 are trained)
+                trunk_output = self.backbone.get_layer('mixed8').output
+                fine_tune_at = self.backbone.layers.index(self.backbone.get_layer('mixed8')) + 1
+                for layer in self.backbone.layers[:fine_tune_at]:
+                    layer.trainable = False
+                for layer in self.backbone.layers[fine_tune_at:]:
+                    layer.trainable = True
+
+                # Frozen layers are computed once for every item, only the trainable head is trained
+                self.model_frozen = tf.keras.Model(inputs=self.backbone.input, outputs=trunk_output)
+                head = tf.keras.Model(inputs=trunk_output, outputs=self.backbone.output)
+
+                # Cached features are quantized to uint8 with per-channel scale set during extraction
+                self.dequantize = Dequantize()
+
+                input_target = tf.keras.layers.Input(trunk_output.shape[1:], dtype='uint8')
+                input_context = tf.keras.layers.Input(trunk_output.shape[1:], dtype='uint8')
+                target_output = head(self.dequantize(input_target))
+                context_output = head(self.dequantize(input_context))
+            else:
+                target_output = self.backbone(input_target)
+                context_output = self.backbone(input_context)
+
+            # Cosine similarities of every target with every context in the batch (in float32 for stable softmax)
+            similarity = tf.keras.layers.Lambda(losses.similarity_matrix, dtype='float32')(
+                [target_output, context_output])
+
+            # Create model
+            self.model = tf.keras.Model(inputs=[input_target, input_context], outputs=similarity)
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(tf.keras.optimizers.Adam())
+            if hparams[HP_LOSS] == 'semi_hard':
+                loss = losses.semi_hard_triplet_loss()
+            else:
+                loss = losses.in_batch_softmax_loss()
+            self.model.compile(loss=loss, optimizer=optimizer, metrics=[losses.in_batch_accuracy])
 
-        # Rename layers
-        for i, layer in enumerate(self.model_target.layers):
-            layer._name = 'target_' + str(i)
-            if i == len(self.model_target.layers) - 1:
-                layer._name = 'target_last_layer'
-        for i, layer in enumerate(self.model_context.layers):
-            layer._name = 'context_' + str(i)
-            if i == len(self.model_context.layers) - 1:
-                layer._name = 'context_last_layer'
-
-        if hparams[HP_FINE_TUNE]:
-            # Set up fine-tuning
-            for layer in self.model_target.layers[:249]:
-                layer.trainable = False
-            for layer in self.model_target.layers[249:]:
-                layer.trainable = True
-            for layer in self.model_context.layers[:249]:
-                layer.trainable = False
-            for layer in self.model_context.layers[249:]:
-                layer.trainable = True
-
-        # Perform dot product
-        dot_product = tf.keras.layers.dot(
-            [self.model_target.get_layer("target_last_layer").output,
-             self.model_context.get_layer("context_last_layer").output], axes=1)
-        dot_product = tf.keras.layers.Reshape((1,))(dot_product)
-
-        # Sigmoid layer
-        output = tf.keras.layers.Dense(1, activation='sigmoid')(dot_product)
-
-        # Create model and generator
-
-        self.model = tf.keras.Model(inputs=[input_target, input_context], outputs=output)
-        self.model = tf.keras.utils.multi_gpu_model(self.model, gpus=2)
-        self.model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
+        # Create generator (batches are split between replicas)
         self.generator = SamplesGenerator(
             dataset_path,
             images_path,
-            batch_size=batch_size,
+            batch_size=batch_size * self.strategy.num_replicas_in_sync,
             samples_count_limit=samples_count_limit,
             outfits_count_limit=outfits_count_limit
         )
         print("Style2Vec model has been successfully initialized.")
 
-    def fit(self):
+    def fit(self, profile: bool = False):
+        """
+        Trains the model
+        :param profile: Trace the first epoch with TF Profiler (viewable in TensorBoard)
+        """
         print("Model fitting has started.")
         self.generator.generate_samples()
-        self.history = self.model.fit_generator(
-            self.generator.generate_batches(),
-            steps_per_epoch=self.generator.steps_per_epoch,
-            epochs=self.epochs_count,
-            verbose=2,
-            callbacks=[
-                tf.keras.callbacks.TensorBoard("logs/" + date,
-                                               update_freq=10000, write_graph=False),  # log metrics
-                tf.keras.callbacks.ModelCheckpoint("logs/" + date + "/chckpts/weights.{epoch:02d}.hdf5")
-            ],
-            workers=8,
-            use_multiprocessing=True,
-        )
+        features = None
+        if self.model_frozen is not None:
+            features = self.extract_frozen_features()
+        dataset = self.generator.as_dataset(features)
+        callbacks = [
+            tf.keras.callbacks.TensorBoard("logs/" + date, update_freq='epoch', write_graph=False,
+                                           profile_batch=0),  # log metrics
+            tf.keras.callbacks.ModelCheckpoint("logs/" + date + "/chckpts/weights.h5", monitor='loss',
+                                               save_best_only=True, save_weights_only=True, save_freq='epoch')
+        ]
+
+        self.history = None
+        initial_epoch = 0
+        if profile:
+            tf.profiler.experimental.start("logs/" + date)
+            try:
+                self.history = self.model.fit(dataset, steps_per_epoch=self.generator.steps_per_epoch, epochs=1,
+                                              verbose=2, callbacks=callbacks)
+            finally:
+                tf.profiler.experimental.stop()
+            initial_epoch = 1
+
+        if initial_epoch < self.epochs_count:
+            history = self.model.fit(
+                dataset,
+                steps_per_epoch=self.generator.steps_per_epoch,
+                epochs=self.epochs_count,
+                initial_epoch=initial_epoch,
+                verbose=2,
+                callbacks=callbacks
+            )
+            if self.history is None:
+                self.history = history
+            else:
+                # Merge with the profiled epoch
+                self.history.epoch += history.epoch
+                for key, values in history.history.items():
+                    self.history.history.setdefault(key, []).extend(values)
+
+    def extract_frozen_features(self, batch_size: int = 32, calibration_size: int = 1024):
+        """
+        Runs frozen part of the model once over every cached image and quantizes its output to uint8
+        :param batch_size: Number of images in one prediction batch
+        :param calibration_size: Number of randomly chosen images used to find per-channel quantization scale
+        :return: Array with quantized frozen features indexed by image index
+        """
+        if self.generator.image_cache is None:
+            self.generator.build_image_cache()
+
+        images = self.generator.image_cache
+        features_shape = tuple(self.model_frozen.output_shape[1:])
+
+        # Calibrate on a random subset (sorted for sequential cache reads), its features are kept for quantization
+        calibration = np.sort(np.random.choice(len(images), min(len(images), calibration_size), replace=False))
+        calibration_features = np.empty((len(calibration),) + features_shape, dtype=np.float16)
+        for start in range(0, len(calibration), batch_size):
+            indexes = calibration[start:start + batch_size]
+            calibration_features[start:start + batch_size] = self.model_frozen.predict_on_batch(images[indexes])
+
+        # Mixed block outputs are non-negative (ReLU), so the scale maps channel maximum to 255
+        channel_max = np.max(calibration_features, axis=(0, 1, 2)).astype(np.float32)
+        scale = np.maximum(channel_max, 1e-6) / 255.
+        self.dequantize.scale.assign(scale)
+
+        features = np.empty((len(images),) + features_shape, dtype=np.uint8)
+        for start in range(0, len(calibration), batch_size):
+            indexes = calibration[start:start + batch_size]
+            features[indexes] = quantize(calibration_features[start:start + batch_size], scale)
+
+        remaining = np.setdiff1d(np.arange(len(images)), calibration)
+        for start in range(0, len(remaining), batch_size):
+            indexes = remaining[start:start + batch_size]
+            features[indexes] = quantize(self.model_frozen.predict_on_batch(images[indexes]), scale)
+        print("Frozen features have been successfully extracted.")
+        return features
 
     def plot_model(self):
         tf.keras.utils.plot_model(
@@ -135,18 +229,28 @@ class Style2Vec:
         self.model.save(model_filepath)
 
 
+def quantize(features, scale: np.ndarray) -> np.ndarray:
+    """
+    Quantizes non-negative features to uint8
+    :param features: Array with features
+    :param scale: Per-channel quantization scale
+    :return: uint8 array with quantized features
+    """
+    return np.clip(np.round(np.asarray(features, dtype=np.float32) / scale), 0, 255).astype(np.uint8)
+
+
 HP_OPTIMIZER = hp.HParam('optimizer', hp.Discrete(['adam', 'sgd']))
 HP_BATCH_SIZE = hp.HParam('batch_size', hp.Discrete([8, 16, 24, 32, 48]))
-HP_NEGATIVE_SAMPLES = hp.HParam('negative_samples', hp.Discrete([6, 12, 18]))
 HP_FINE_TUNE = hp.HParam('fine_tune', hp.Discrete([True, False]))
+HP_LOSS = hp.HParam('loss', hp.Discrete(['softmax', 'semi_hard']))
 
 METRIC_ACCURACY = 'accuracy'
 
 hyperparams = {
     HP_BATCH_SIZE: 5,
-    HP_NEGATIVE_SAMPLES: 6,
     HP_OPTIMIZER: 'adam',
-    HP_FINE_TUNE: True
+    HP_FINE_TUNE: True,
+    HP_LOSS: 'semi_hard'
 }
 
 model = Style2Vec("../data/label/train_no_dup_out.json",
@@ -157,13 +261,13 @@ model = Style2Vec("../data/label/train_no_dup_out.json",
                   hparams=hyperparams)
 
 try:
-    start = time.clock()
+    start = time.perf_counter()
     model.fit()
-    end = time.clock()
+    end = time.perf_counter()
     model.save('logs/' + date + '/' + 'model' + date + '.h5')
     with open('logs/' + date + '/meta.txt', "w+") as time_file:
-        time_file.write('batch 24, limit -1, adam, e 5, fine tune, neg 6\n')
-        time_file.write(str(start - end))
+        time_file.write('batch 24, limit -1, adam, e 5, fine tune, semi-hard negatives\n')
+        time_file.write(str(end - start))
     print("Succesfully finished.")
 except Exception as e:
     model.save('model' + date + '_err.h5')